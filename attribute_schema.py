@@ -0,0 +1,311 @@
+################################################################################
+# Copyright (c) 2017-2022                                                      #
+# Intwine Connect, LLC.                                                        #
+################################################################################
+
+"""Per-attribute value schemas for CloudBUS data
+
+CloudBUS reports attribute values exactly as the device sent them, which means
+a single attribute can arrive as numbers, numeric strings, booleans or free
+text. This module keeps a registry of what each attribute actually holds so
+that a whole y_vector can be decoded into a typed NumPy array in one step
+instead of every caller running its own float( ) loop.
+
+Schemas are taken from the device information when the platform reports a
+data type for an attribute, and otherwise inferred by sampling the values.
+Declared schemas are cached in the registry for every device, while inferred
+ones are only reused for the device they were inferred from, and only while
+its data keeps looking the same. Numeric samples are always inferred as FLOAT;
+INT is only used when the device information declares it.
+"""
+
+import numpy as np
+
+FLOAT = 'float'
+INT = 'int'
+BOOL = 'bool'
+ENUM = 'enum'
+
+# number of values inspected when inferring a schema from data
+SAMPLE_SIZE = 256
+
+_TRUE_STRINGS = ('true', 'on', 'yes')
+_FALSE_STRINGS = ('false', 'off', 'no')
+
+# device info type names mapped onto schema kinds
+_TYPE_NAMES = {
+    'float': FLOAT, 'double': FLOAT, 'decimal': FLOAT, 'number': FLOAT,
+    'int': INT, 'integer': INT, 'long': INT, 'short': INT,
+    'bool': BOOL, 'boolean': BOOL,
+    'enum': ENUM, 'string': ENUM, 'text': ENUM,
+}
+
+
+class AttributeSchema:
+    """Description of the values reported for a single attribute
+
+    Args:
+        kind:   one of FLOAT, INT, BOOL or ENUM
+        labels: for ENUM attributes, the list of known labels. The index of a
+            label in this list is the code it decodes to. New labels seen while
+            decoding are appended, so codes are stable for the life of the
+            schema.
+    """
+
+    def __init__(self, kind, labels=None):
+        if kind not in (FLOAT, INT, BOOL, ENUM):
+            raise ValueError("Unknown schema kind '%s'" % kind)
+        self.kind = kind
+        self.labels = list(labels) if labels else []
+
+    def __repr__(self):
+        if self.kind == ENUM:
+            return "AttributeSchema(%r, labels=%r)" % (self.kind, self.labels)
+        return "AttributeSchema(%r)" % (self.kind,)
+
+    @property
+    def dtype(self):
+        """NumPy dtype of the decoded values"""
+        if self.kind == FLOAT:
+            return np.dtype(np.float64)
+        if self.kind == BOOL:
+            return np.dtype(np.bool_)
+        if self.kind == ENUM:
+            return np.dtype(np.int32)
+        return np.dtype(np.int64)
+
+    def decode(self, values):
+        """Decode raw attribute values into a typed masked array
+
+        Args:
+            values: sequence of values as returned by the CloudBUS API
+
+        Returns:
+            A numpy.ma.MaskedArray of self.dtype with the same length as values.
+            Values that can not be interpreted as this schema are masked.
+        """
+        if self.kind == ENUM:
+            return self._decode_enum(values)
+        if self.kind == BOOL:
+            return self._decode_bool(values)
+
+        y = _to_float(values)
+        if self.kind == FLOAT:
+            return np.ma.masked_invalid(y)
+
+        bad = ~np.isfinite(y)
+        y[bad] = 0.0
+        bad |= y != np.round(y)
+        return np.ma.MaskedArray(y.astype(np.int64), mask=bad)
+
+    def decode_value(self, value):
+        """Decode a single value, returning None when it can not be parsed"""
+        y = self.decode([value])
+        if y.mask.any():
+            return None
+        return y[0].item()
+
+    def _decode_bool(self, values):
+        raw = np.asarray(values, dtype=object)
+        text = np.char.lower(np.char.strip(raw.astype(str)))
+        y = np.isin(text, _TRUE_STRINGS)
+        bad = ~(y | np.isin(text, _FALSE_STRINGS))
+
+        # anything numeric is truthy when it is non-zero
+        num = _to_float(raw[bad]) if bad.any() else np.empty(0)
+        parsed = np.isfinite(num)
+        idx = np.flatnonzero(bad)
+        y[idx[parsed]] = num[parsed] != 0
+        bad[idx[parsed]] = False
+        return np.ma.MaskedArray(y, mask=bad)
+
+    def _decode_enum(self, values):
+        raw = np.asarray(values, dtype=object)
+        missing = np.array([v is None for v in raw], dtype=bool)
+        y = np.zeros(len(raw), dtype=np.int32)
+        if missing.all():
+            return np.ma.MaskedArray(y, mask=missing)
+
+        # look up each distinct label once rather than once per point
+        uniq, inverse = np.unique(raw[~missing].astype(str), return_inverse=True)
+        lookup = dict((label, i) for i, label in enumerate(self.labels))
+        codes = np.empty(len(uniq), dtype=np.int32)
+        for i, label in enumerate(uniq.tolist()):
+            if label not in lookup:
+                lookup[label] = len(self.labels)
+                self.labels.append(label)
+            codes[i] = lookup[label]
+        y[~missing] = codes[inverse.ravel()]
+        return np.ma.MaskedArray(y, mask=missing)
+
+
+def _to_float(values):
+    """Convert values to a float64 array with NaN wherever parsing failed"""
+    raw = np.asarray(values, dtype=object)
+    try:
+        # fast path: everything is already a number or a numeric string
+        return raw.astype(np.float64)
+    except (TypeError, ValueError):
+        pass
+    y = np.full(raw.shape, np.nan)
+    for i, v in enumerate(raw):
+        try:
+            y[i] = float(v)
+        except (TypeError, ValueError):
+            pass
+    return y
+
+
+def infer_schema(values):
+    """Infer an AttributeSchema by sampling reported values
+
+    Args:
+        values: sequence of values as returned by the CloudBUS API
+
+    Returns:
+        The AttributeSchema that best describes the sample, or None when there
+        were no values to look at.
+    """
+    sample = [v for v in values[-SAMPLE_SIZE:] if v is not None]
+    if not sample:
+        return None
+
+    if all(isinstance(v, bool) for v in sample):
+        return AttributeSchema(BOOL)
+    text = np.char.lower(np.char.strip(np.asarray(sample).astype(str)))
+    if np.isin(text, _TRUE_STRINGS + _FALSE_STRINGS).all():
+        return AttributeSchema(BOOL)
+
+    y = _to_float(sample)
+    parsed = ~np.isnan(y)
+    # mostly numbers with the odd bad reading are still numbers
+    if parsed.mean() < 0.5:
+        return AttributeSchema(ENUM)
+    # a sample of whole numbers doesn't mean the next device won't report
+    # fractions, so only the device information can declare an INT
+    return AttributeSchema(FLOAT)
+
+
+def schemas_from_device_info(info):
+    """Extract attribute schemas from a getDeviceInfo( ) response
+
+    The device information does not have a fixed layout across device types,
+    so this looks for any list of attribute descriptions that carry both a
+    name and a data type.
+
+    Args:
+        info: the dictionary returned by cbDevice.getDeviceInfo( )
+
+    Returns:
+        A dictionary of attribute name to AttributeSchema. Attributes without
+        a recognised type are left out.
+    """
+    schemas = {}
+    if not isinstance(info, dict):
+        return schemas
+
+    for key in ('attributes', 'attrs', 'capabilities', 'dataPoints'):
+        entries = info.get(key)
+        if not isinstance(entries, list):
+            continue
+        for entry in entries:
+            if not isinstance(entry, dict):
+                continue
+            name = entry.get('name') or entry.get('attr') or entry.get('id')
+            type_name = (entry.get('type') or entry.get('dataType') or
+                         entry.get('valueType'))
+            if not name or not type_name:
+                continue
+            kind = _TYPE_NAMES.get(str(type_name).lower())
+            if kind is None:
+                continue
+            schemas[name] = AttributeSchema(kind, entry.get('values'))
+    return schemas
+
+
+class SchemaRegistry:
+    """Cache of AttributeSchema objects
+
+    Schemas declared by device information are shared by every device and keyed
+    by attribute name. Inferred schemas only describe the data one device has
+    reported, so they are kept per device and are checked against each new
+    sample before they are reused.
+    """
+
+    def __init__(self):
+        self._schemas = {}
+        self._inferred = {}
+        self._devices_seen = set()
+
+    def __contains__(self, attr):
+        return attr in self._schemas
+
+    def get(self, attr, guid=None):
+        """Returns the cached schema for attr or None if it is not known
+
+        A declared schema is returned if there is one, otherwise the schema
+        last inferred for attr on device guid.
+        """
+        schema = self._schemas.get(attr)
+        if schema is None:
+            schema = self._inferred.get((guid, attr))
+        return schema
+
+    def register(self, attr, schema):
+        """Declares the schema of an attribute, replacing any cached one"""
+        self._schemas[attr] = schema
+
+    def clear(self):
+        """Forget every cached schema"""
+        self._schemas.clear()
+        self._inferred.clear()
+        self._devices_seen.clear()
+
+    def load_device_info(self, guid, info):
+        """Registers schemas found in a device's information
+
+        Each device is only examined once. Schemas that are already cached are
+        kept so that ENUM codes stay stable.
+        """
+        self._devices_seen.add(guid)
+        for attr, schema in schemas_from_device_info(info).items():
+            self._schemas.setdefault(attr, schema)
+
+    def has_device(self, guid):
+        return guid in self._devices_seen
+
+    def resolve(self, attr, values, guid=None):
+        """Returns the schema for attr, inferring it from values if needed
+
+        A schema inferred earlier for the same device is only reused when the
+        new values infer to the same kind, so one response full of bad readings
+        can't decide how every later response is decoded. An inferred ENUM is
+        never cached, since its codes only mean something within one response.
+        """
+        schema = self._schemas.get(attr)
+        if schema is not None:
+            return schema
+
+        key = (guid, attr)
+        cached = self._inferred.get(key)
+        schema = infer_schema(values)
+        if schema is None:
+            return cached
+        if cached is not None and cached.kind == schema.kind:
+            return cached
+        if schema.kind == ENUM:
+            self._inferred.pop(key, None)
+        else:
+            self._inferred[key] = schema
+        return schema
+
+    def decode(self, attr, values, guid=None):
+        """Decodes values reported for attr into a typed masked array"""
+        schema = self.resolve(attr, values, guid)
+        if schema is None:
+            return np.ma.MaskedArray(np.empty(0, dtype=np.float64))
+        return schema.decode(values)
+
+
+# schemas shared by every cbDevice in the process
+registry = SchemaRegistry()
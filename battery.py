@@ -0,0 +1,135 @@
+################################################################################
+# Copyright (c) 2017-2022                                                      #
+# Intwine Connect, LLC.                                                        #
+################################################################################
+
+"""Fleet battery life estimates from battery_remaining data
+
+Each device's battery_remaining series is split into discharge cycles at the
+points where the level jumps up, which is a recharge or a battery replacement.
+A straight line is then fitted to the current (last) cycle of every device
+and the slope of that line gives the discharge rate, the expected life of a
+full battery and the time left on the current one, along with confidence
+intervals from the standard error of the slope.
+
+All devices are fitted together: the series are concatenated and the least
+squares sums are accumulated per device with numpy.bincount, so the cost does
+not grow with a Python loop over the fleet.
+"""
+
+import numpy as np
+
+from counters import _concat_series
+
+# a rise in battery_remaining larger than this starts a new discharge cycle
+RECHARGE_JUMP = 0.1
+# z value of the reported confidence intervals (95%)
+CONFIDENCE_Z = 1.96
+
+_MS_PER_DAY = 24 * 60 * 60 * 1000.0
+
+
+def _per_group(group, weights, ngroups):
+    return np.bincount(group, weights=weights, minlength=ngroups)
+
+
+def fleet_battery_life(series, recharge_jump=RECHARGE_JUMP, z=CONFIDENCE_Z):
+    """Estimate battery life for many devices in one pass
+
+    Args:
+        series:        a list of (t, y) pairs, one per device, with y the
+            battery_remaining fraction (1.0 is full) in time order. t may be
+            anything counters.to_datetime64( ) accepts, such as the output of
+            cbDevice.getData( ) or cbDevice.scanBackward( ).
+        recharge_jump: rise in level that marks a recharge or replacement
+        z:             z value used for the confidence intervals
+
+    Returns:
+        A dictionary of numpy arrays with one element per device:
+
+        * cycle_start: time the current discharge cycle started (NaT if none).
+          This is only the time of a recharge or replacement when there was
+          one within the data given; otherwise it is simply the first point.
+        * start_level: battery level at cycle_start
+        * current: the most recent battery level
+        * points: number of points in the current cycle
+        * events: number of recharge or replacement events seen
+        * rate: fitted discharge rate in fraction per day
+        * life, life_low, life_high: days for a full battery to run down,
+          with its confidence interval
+        * remaining, remaining_low, remaining_high: days until the battery
+          is empty at the fitted rate, with its confidence interval
+
+        Estimates are NaN when the current cycle has fewer than three points
+        or the battery is not discharging. An upper bound is inf when the
+        discharge rate could be zero within the confidence interval.
+    """
+    ngroups = len(series)
+    t, y, group = _concat_series(series)
+    valid = np.isfinite(y)
+    t, y, group = t[valid], y[valid], group[valid]
+    days = t.astype(np.int64) / _MS_PER_DAY
+
+    # split into discharge cycles at each recharge or replacement
+    same = np.zeros(len(y), dtype=bool)
+    same[1:] = group[1:] == group[:-1]
+    jump = same.copy()
+    jump[1:] &= (y[1:] - y[:-1]) > recharge_jump
+    cycle = np.cumsum(jump)
+    ends = np.flatnonzero(np.append(~same[1:], len(y) > 0))
+    last_cycle = np.zeros(ngroups, dtype=np.int64)
+    last_cycle[group[ends]] = cycle[ends]
+    cur = cycle == last_cycle[group]
+    events = _per_group(group, jump, ngroups).astype(np.int64)
+
+    current = np.full(ngroups, np.nan)
+    current[group[ends]] = y[ends]
+    cycle_start = np.full(ngroups, np.datetime64('NaT'), dtype='datetime64[ms]')
+    start_level = np.full(ngroups, np.nan)
+    starts = np.flatnonzero(cur & ~(same & np.roll(cur, 1)))
+    cycle_start[group[starts]] = t[starts]
+    start_level[group[starts]] = y[starts]
+
+    # least squares fit of level against time over each current cycle
+    g, x, v = group[cur], days[cur], y[cur]
+    n = _per_group(g, None, ngroups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = _per_group(g, x, ngroups) / n
+        y_mean = _per_group(g, v, ngroups) / n
+        dx = x - x_mean[g]
+        dy = v - y_mean[g]
+        sxx = _per_group(g, dx * dx, ngroups)
+        sxy = _per_group(g, dx * dy, ngroups)
+        slope = sxy / sxx
+        resid = dy - slope[g] * dx
+        ssr = _per_group(g, resid * resid, ngroups)
+        se = np.sqrt(ssr / (n - 2) / sxx)
+
+        rate = -slope
+        fit = (n >= 3) & (sxx > 0) & (rate > 0)
+        rate[~fit] = np.nan
+        se[~fit] = np.nan
+        rate_low = rate - z * se
+        rate_high = rate + z * se
+        # a rate that may be zero gives an unbounded life
+        inv_low = np.where(rate_low > 0, 1.0 / rate_low, np.inf)
+        inv_low[~fit] = np.nan
+
+        life = 1.0 / rate
+        life_low = 1.0 / rate_high
+        life_high = inv_low
+
+    return {
+        'cycle_start': cycle_start,
+        'start_level': start_level,
+        'current': current,
+        'points': n.astype(np.int64),
+        'events': events,
+        'rate': rate,
+        'life': life,
+        'life_low': life_low,
+        'life_high': life_high,
+        'remaining': current * life,
+        'remaining_low': current * life_low,
+        'remaining_high': current * life_high,
+    }
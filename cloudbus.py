@@ -34,10 +34,22 @@ if sys.version_info[0] == 2:
 
 import json
 import datetime as dt
+from bisect import bisect_left
 from base64 import b64encode
 
+import numpy as np
+
+from attribute_schema import registry, infer_schema
+from timeseries import TimeSeries
+
 CBUS_IP = "cbws.intwineconnect.com:8080"
 
+# First window requested by getLatest and scanBackward. Each further request
+# reaches twice as far back as the one before.
+SCAN_WINDOW = dt.timedelta(days=1)
+# How far back from tend getLatest and scanBackward will look before giving up
+SCAN_LOOKBACK = dt.timedelta(days=366)
+
 # OAuth2 client information
 GET_TOKEN = "/cloudbus/oauth/token"
 clientId = ""
@@ -131,7 +143,36 @@ class cbDevice:
         assert guid, "GUID can not be empty"
         self.__init__(guid)
 
-    def getData(self, variable, tstart=None, tend=None):
+    def getSchema(self, variable, values=None):
+        """Get the schema used to decode values of an attribute
+
+        The schema is looked up in the shared attribute_schema registry. The
+        first time an undeclared attribute is requested for this device, its
+        device information is checked for declared attribute types. Failing
+        that, or if the device information can't be fetched, the schema is
+        inferred from values, if given, and cached for this device only.
+
+        Args:
+            variable: name of the attribute
+            values:   optional list of reported values to infer a schema from
+
+        Returns:
+            An attribute_schema.AttributeSchema, or None if it can't be known.
+        """
+        if variable not in registry and not registry.has_device(self.guid):
+            try:
+                info = self.getDeviceInfo()
+            except (IOError, ValueError) as e:
+                # the data is still usable without declared types
+                print("Device info unavailable for %s: %s" % (self.guid, e))
+                info = {}
+            registry.load_device_info(self.guid, info)
+        if values is None:
+            return registry.get(variable, self.guid)
+        return registry.resolve(variable, values, self.guid)
+
+    def getData(self, variable, tstart=None, tend=None, decode=False,
+                series=False):
         """Get data from the CloudBUS device APIs
 
         Request all reported values of data sent to CloudBUS from this specific
@@ -144,6 +185,13 @@ class cbDevice:
                 the specified attribute. Defaults to Unix time of 0.
             tend:     optional datetime of the most recent time for which to request
                 the specified attribute. Defaults to tomorrow.
+            decode:   if True, element 1 of the returned tuple is a typed
+                numpy.ma.MaskedArray decoded using the attribute's schema (see
+                getSchema) with unparseable values masked.
+            series:   if True, return a compressed timeseries.TimeSeries of
+                epoch millisecond timestamps and decoded float values instead
+                of a tuple. Masked values are stored as NaN. Use this to hold
+                long histories for many devices in memory.
 
         Returns:
             A tuple of lists. Element 0 of the tuple is a list of datetimes
@@ -172,7 +220,13 @@ class cbDevice:
 
         # format the data to be returned
         data = dict(resp["data"])
-        a = sorted(data.items())
+        a = sorted(data.items(), key=lambda i: float(i[0]))
+
+        if series:
+            t_ms = [int(float(i[0])) for i in a]
+            y_vector = self._decodeData(variable, [i[1] for i in a])
+            return TimeSeries.from_arrays(t_ms, y_vector.astype(float))
+
         t_vector = []
         y_vector = []
         for i in a:
@@ -181,9 +235,126 @@ class cbDevice:
             t_vector.append(dt.datetime.fromtimestamp(float(i[0]) / 1000.0))
             # y_vector.append( float(i[1]) )
             y_vector.append(i[1])
+
+        if decode:
+            y_vector = self._decodeData(variable, y_vector)
         return t_vector, y_vector
 
-    def getCurrentData(self):
+    def _scanChunks(self, variable, tend=None, lookback=None):
+        # yields decoded (t, y) chunks, newest first, over windows that double
+        # in length until lookback before tend (or the start of Unix time)
+        if tend is None:
+            tend = dt.datetime.now() + dt.timedelta(days=1)  # tomorrow
+        if lookback is None:
+            lookback = SCAN_LOOKBACK
+        limit = dt.datetime.fromtimestamp(0)
+        if tend - limit > lookback:
+            limit = tend - lookback
+        window = SCAN_WINDOW
+
+        end = tend
+        while end > limit:
+            start = max(end - window, limit)
+            t, y = self.getData(variable, start, end, decode=True)
+            if end is not tend:
+                # the previous chunk already holds anything at or after end
+                keep = bisect_left(t, end)
+                t, y = t[:keep], y[:keep]
+            yield t, y
+            end = start
+            window *= 2
+
+    def getLatest(self, variable, n=1, tend=None, lookback=None):
+        """Get the most recent values of an attribute
+
+        Rather than downloading the whole history, data is requested over
+        windows ending at tend that grow exponentially (see SCAN_WINDOW) until
+        at least n points have been found.
+
+        Args:
+            variable: name of the attribute
+            n:        number of points to return
+            tend:     optional datetime to look back from. Defaults to tomorrow.
+            lookback: optional timedelta, how far back from tend to look.
+                Defaults to SCAN_LOOKBACK.
+
+        Returns:
+            A tuple like getData(decode=True) with at most n points, the last
+            of which is the most recent reported value. Fewer than n points
+            are returned if that is all there is within lookback.
+        """
+        t_chunks = []
+        y_chunks = []
+        count = 0
+        for t, y in self._scanChunks(variable, tend, lookback):
+            t_chunks.insert(0, t)
+            y_chunks.insert(0, y)
+            count += len(t)
+            if count >= n:
+                break
+        return _joinChunks(t_chunks, y_chunks, n)
+
+    def scanBackward(self, variable, predicate, tend=None, lookback=None):
+        """Get the data reported since an attribute last matched a condition
+
+        Data is requested over windows ending at tend that grow exponentially
+        (see SCAN_WINDOW), newest first, and the scan stops at the first
+        window holding a value that satisfies predicate, or once it has gone
+        lookback before tend.
+
+        Args:
+            variable:  name of the attribute
+            predicate: function taking an array of decoded values and returning
+                an array of booleans, e.g. lambda y: y > 0.999
+            tend:      optional datetime to look back from. Defaults to
+                tomorrow.
+            lookback:  optional timedelta, how far back from tend to look.
+                Defaults to SCAN_LOOKBACK.
+
+        Returns:
+            A tuple like getData(decode=True) starting at the most recent point
+            that satisfied predicate and running up to tend. If nothing within
+            lookback satisfied it, everything found within lookback is
+            returned instead, so check predicate on the first point to tell
+            the two apart.
+        """
+        t_chunks = []
+        y_chunks = []
+        for t, y in self._scanChunks(variable, tend, lookback):
+            t_chunks.insert(0, t)
+            y_chunks.insert(0, y)
+            if len(t) == 0:
+                continue
+            match = np.ma.filled(np.ma.asarray(predicate(y), dtype=bool),
+                                 False)
+            hits = np.flatnonzero(match)
+            if len(hits):
+                t_chunks[0] = t[hits[-1]:]
+                y_chunks[0] = y[hits[-1]:]
+                break
+        return _joinChunks(t_chunks, y_chunks)
+
+    def _decodeData(self, variable, y_vector):
+        # decode a y_vector with the attribute's schema, always returning a
+        # MaskedArray even when there is nothing to infer a schema from
+        schema = self.getSchema(variable, y_vector)
+        if schema is None:
+            return np.ma.masked_all(len(y_vector), dtype=np.float64)
+        return schema.decode(y_vector)
+
+    def _decodeCurrentData(self, current_data):
+        # decode each (time, value) pair with that attribute's schema. A
+        # single current value is too little to go on, so a schema inferred
+        # from it is used for this call only and is not cached.
+        decoded = {}
+        for k, (t, v) in current_data.items():
+            schema = self.getSchema(k)
+            if schema is None:
+                schema = infer_schema([v])
+            decoded[k] = (t, v if schema is None else schema.decode_value(v))
+        return decoded
+
+    def getCurrentData(self, decode=False):
         """Gets most recently reported data from the device.
 
         This method will return the most recently reported values for all attributes
@@ -195,6 +366,8 @@ class cbDevice:
             Note that the attribute value will be a string since we have no way
             to know the correct data type and things that pass isfloat( ) are
             inconsistent at best.  See https://stackoverflow.com/questions/379906/parse-string-to-float-or-int
+            Pass decode=True to have each value converted using the attribute's
+            schema instead (see getSchema). Unparseable values become None.
         """
         if not self.guid:
             raise Exception("GUID not defined")
@@ -217,6 +390,8 @@ class cbDevice:
                             float(resp["currentData"][k + "_time"]) / 1000.0
                         )
                         current_data[k] = (t, v)
+                    if decode:
+                        return self._decodeCurrentData(current_data)
                     return current_data
                 except AttributeError as e:
                     print("Attribute error: %s" % e)
@@ -231,6 +406,8 @@ class cbDevice:
                 )
                 current_data[k] = (t, v)
 
+        if decode:
+            return self._decodeCurrentData(current_data)
         return current_data
 
     def getDeviceInfo(self):
@@ -250,6 +427,19 @@ class cbDevice:
         return get_response(url + self.guid, headers=self.oauth_header)
 
 
+def _joinChunks(t_chunks, y_chunks, n=None):
+    # join oldest-first chunks from _scanChunks, keeping the last n points
+    t = [x for chunk in t_chunks for x in chunk]
+    if not y_chunks:
+        # nothing was requested, e.g. a zero lookback
+        return t, np.ma.masked_all(0, dtype=np.float64)
+    y = np.ma.concatenate([np.ma.asarray(chunk) for chunk in y_chunks])
+    if n is not None:
+        t = t[len(t) - n:] if len(t) > n else t
+        y = y[len(y) - len(t):]
+    return t, y
+
+
 class cbGateway(cbDevice):
     """CloudBUS Gateway device"""
 
@@ -302,7 +492,7 @@ class cbGateway(cbDevice):
 
         return devices
 
-    def getCurrentData(self):
+    def getCurrentData(self, decode=False):
         """Gets most recently reported data from the gateway.
 
         This method will return the most recently reported values for all attributes
@@ -314,6 +504,8 @@ class cbGateway(cbDevice):
             Note that the attribute value will be a string since we have no way
             to know the correct data type and things that pass isfloat( ) are
             inconsistent at best.  See https://stackoverflow.com/questions/379906/parse-string-to-float-or-int
+            Pass decode=True to have each value converted using the attribute's
+            schema instead (see getSchema). Unparseable values become None.
         """
         if not self.guid:
             raise Exception("GUID not defined")
@@ -337,6 +529,8 @@ class cbGateway(cbDevice):
             )
             current_data[k] = (t, v)
 
+        if decode:
+            return self._decodeCurrentData(current_data)
         return current_data
 
     def getMetaData(self):
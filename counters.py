@@ -0,0 +1,230 @@
+################################################################################
+# Copyright (c) 2017-2022                                                      #
+# Intwine Connect, LLC.                                                        #
+################################################################################
+
+"""Vectorized handling of cumulative counters such as 4gdata-use
+
+Attributes like 4gdata-use report a running total that only ever goes up,
+until the modem reboots and the counter starts again from zero, or until a
+fixed width counter wraps around. These functions turn such counters into
+per-interval usage and rates, and roll the usage up per day or per billing
+period.
+
+Everything works on flat NumPy arrays so that a whole fleet can be processed
+in one call: fleet_usage( ) concatenates every device's series and keeps them
+apart with a group index instead of looping over devices in Python.
+
+Times may be given as datetimes (as returned by cbDevice.getData( )), as
+numpy datetime64 values, or as integer epoch milliseconds (as stored in a
+timeseries.TimeSeries). Datetimes are binned by their own calendar, which for
+getData( ) output is local time; epoch milliseconds are binned in UTC.
+"""
+
+import numpy as np
+
+# a drop from above this fraction of the wrap value is taken to be a wraparound
+WRAP_FRACTION = 0.5
+
+
+def to_datetime64(t):
+    """Convert times to a numpy datetime64[ms] array"""
+    t = np.asarray(t)
+    if t.dtype.kind in 'iuf':
+        return t.astype(np.int64).astype('datetime64[ms]')
+    return t.astype('datetime64[ms]')
+
+
+def _as_groups(group, n):
+    if group is None:
+        return np.zeros(n, dtype=np.int64)
+    return np.asarray(group, dtype=np.int64)
+
+
+def _group_starts(group):
+    starts = np.ones(len(group), dtype=bool)
+    starts[1:] = group[1:] != group[:-1]
+    return starts
+
+
+def _as_values(y):
+    return np.asarray(np.ma.filled(np.ma.asarray(y, dtype=np.float64), np.nan))
+
+
+def _concat_series(series):
+    """Join per-device (t, y) pairs into flat arrays
+
+    Returns:
+        A tuple of datetime64[ms] times, float values with NaN for masked
+        readings, and the index into series of each point.
+    """
+    lengths = np.array([len(y) for t, y in series], dtype=np.int64)
+    group = np.repeat(np.arange(len(series)), lengths)
+    if not lengths.sum():
+        return (np.empty(0, dtype='datetime64[ms]'),
+                np.empty(0, dtype=np.float64), group)
+    t = np.concatenate([to_datetime64(t) for t, y in series])
+    y = np.concatenate([_as_values(y) for t, y in series])
+    return t, y, group
+
+
+def _previous(x, group, valid):
+    """The previous valid value of x in the same group, NaN if there is none
+
+    Invalid points are skipped rather than breaking the series, so the usage
+    across a missing reading is credited to the next good one.
+    """
+    prev = np.full(len(x), np.nan)
+    xv = x[valid]
+    pv = np.empty(len(xv))
+    pv[0:1] = np.nan
+    pv[1:] = xv[:-1]
+    pv[_group_starts(group[valid])] = np.nan
+    prev[valid] = pv
+    return prev
+
+
+def counter_resets(y, group=None):
+    """Find the points where a counter went backwards
+
+    Args:
+        y:     counter values, in time order within each group. Masked and NaN
+            readings are skipped.
+        group: optional integer id per point when y holds several series one
+            after the other
+
+    Returns:
+        A boolean array that is True at each point lower than the previous
+        valid reading.
+    """
+    y = _as_values(y)
+    group = _as_groups(group, len(y))
+    with np.errstate(invalid='ignore'):
+        return y < _previous(y, group, np.isfinite(y))
+
+
+def counter_deltas(y, wrap=None, group=None):
+    """Usage between consecutive counter readings
+
+    A reading lower than the one before is either a wraparound, when wrap is
+    given and the previous reading was near it, or a reset to zero, in which
+    case the usage since the reset is the new reading itself.
+
+    Args:
+        y:     counter values, in time order within each group. Masked and NaN
+            readings are skipped, and the usage across them is credited to the
+            next valid reading.
+        wrap:  optional value at which the counter wraps back to zero, e.g.
+            2**32 for an unsigned 32 bit counter. Only give this when the
+            counter width is known, as any reset from above half of it is
+            otherwise counted as a wraparound.
+        group: optional integer id per point when y holds several series one
+            after the other
+
+    Returns:
+        A float array the same length as y. Invalid readings and the first
+        valid reading of each group have no usage and are NaN.
+    """
+    y = _as_values(y)
+    group = _as_groups(group, len(y))
+    prev = _previous(y, group, np.isfinite(y))
+
+    d = y - prev
+    with np.errstate(invalid='ignore'):
+        reset = d < 0
+        if wrap is not None:
+            wrapped = reset & (prev > wrap * WRAP_FRACTION)
+            d[wrapped] += wrap
+            reset &= ~wrapped
+    d[reset] = y[reset]
+    return d
+
+
+def counter_rates(t, y, wrap=None, group=None):
+    """Counter rate of change per second between consecutive readings
+
+    Args:
+        t:     reading times, see the module documentation
+        y:     counter values, in time order within each group
+        wrap:  optional counter wraparound value, see counter_deltas( )
+        group: optional integer id per point
+
+    Returns:
+        A float array the same length as y, NaN where counter_deltas( ) is and
+        wherever two readings share a timestamp. The rate after a skipped
+        reading is taken over the time since the previous valid one.
+    """
+    t = to_datetime64(t).astype(np.int64) / 1000.0
+    y = _as_values(y)
+    group = _as_groups(group, len(y))
+    d = counter_deltas(y, wrap=wrap, group=group)
+    elapsed = t - _previous(t, group, np.isfinite(y))
+    elapsed[elapsed <= 0] = np.nan
+    return d / elapsed
+
+
+def _period_index(t, period):
+    """Bin times into periods
+
+    Returns:
+        A tuple of (period start times, period index of each time). Times
+        before the first billing boundary get index -1.
+    """
+    t = to_datetime64(t)
+    if isinstance(period, str):
+        p = t.astype('datetime64[%s]' % period)
+        if len(p) == 0:
+            return p.astype('datetime64[ms]'), np.empty(0, dtype=np.int64)
+        first = p.min()
+        idx = (p - first).astype(np.int64)
+        starts = first + np.arange(idx.max() + 1)
+        return starts.astype('datetime64[ms]'), idx
+
+    edges = to_datetime64(period)
+    idx = np.searchsorted(edges, t, side='right') - 1
+    return edges, idx
+
+
+def usage_by_period(t, y, period='D', wrap=None):
+    """Total counter usage per day or per billing period
+
+    Usage between two readings is credited to the period of the later one.
+
+    Args:
+        t:      reading times, see the module documentation
+        y:      counter values in time order
+        period: a numpy datetime unit ('h', 'D', 'M', ...) or a sorted
+            sequence of billing period start times
+        wrap:   optional counter wraparound value, see counter_deltas( )
+
+    Returns:
+        A tuple of numpy arrays: the start of each period and the usage in it.
+    """
+    starts, usage = fleet_usage([(t, y)], period=period, wrap=wrap)
+    return starts, usage[0]
+
+
+def fleet_usage(series, period='D', wrap=None):
+    """Per-period counter usage for many devices in one pass
+
+    Args:
+        series: a list of (t, y) pairs, one per device, as returned by
+            cbDevice.getData( ) or TimeSeries.to_numpy( )
+        period: a numpy datetime unit ('h', 'D', 'M', ...) or a sorted
+            sequence of billing period start times
+        wrap:   optional counter wraparound value, see counter_deltas( )
+
+    Returns:
+        A tuple of the period start times and a 2D array of usage with one row
+        per device and one column per period. The periods are shared by every
+        device so that columns line up across the fleet.
+    """
+    t, y, group = _concat_series(series)
+    d = counter_deltas(y, wrap=wrap, group=group)
+    starts, idx = _period_index(t, period)
+    keep = np.isfinite(d) & (idx >= 0) & (idx < len(starts))
+
+    nbins = len(starts)
+    usage = np.bincount(group[keep] * nbins + idx[keep], weights=d[keep],
+                        minlength=len(series) * nbins)
+    return starts, usage.reshape(len(series), nbins)
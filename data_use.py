@@ -3,35 +3,45 @@
 # Intwine Connect, LLC.                                                        #
 ################################################################################
 
-"""A simple example that will plot and/or save to a csv file the historical
+"""A simple example that will plot and/or save to a csv file the daily
    data use from a given Intwine Gateway or list of systems
 """
 
 from cloudbus import cbDevice
+from counters import fleet_usage
 import matplotlib.pyplot as plt
 
 SAVE_TO_CSV = True
 CREATE_PLOT = True
+# Set to the counter's wraparound value (e.g. 2**32) only if its width is
+# known. Otherwise every drop is treated as a reset to zero on modem reboot.
+COUNTER_WRAP = None
 
 guid_list = ['']  # GUID(s) of interest goes here...
 
+series = []
 for guid in guid_list:
     d = cbDevice(guid)
-    a = d.getData('4gdata-use')
-    mb = [x/1024.0/1024 for x in a[1]]  # convert into MB
+    series.append(d.getData('4gdata-use', decode=True))
 
-    plt.plot(a[0], mb, "o-", alpha=0.5, label=guid[0:4])
+# per-day usage for every gateway at once, with modem reboots and counter
+# wraparounds accounted for
+days, usage = fleet_usage(series, period='D', wrap=COUNTER_WRAP)
+mb = usage / 1024.0 / 1024  # convert into MB
+
+for i, guid in enumerate(guid_list):
+    plt.plot(days, mb[i], "o-", alpha=0.5, label=guid[0:4])
 
     if SAVE_TO_CSV:
         fout = 'data_use_%s.csv' % guid[0:4]
         with open(fout, 'w') as fid:
-            for i in range(0, len(mb)):
-                s = "%s,%s\n" % (a[0][i], mb[i])
+            for j in range(0, len(days)):
+                s = "%s,%s\n" % (days[j], mb[i][j])
                 fid.write(s)
 
 if CREATE_PLOT:
     plt.xlabel('Date')
-    plt.ylabel('Data Use [MB]')
+    plt.ylabel('Daily Data Use [MB]')
     plt.gcf().autofmt_xdate()
     plt.legend()
     plt.show()
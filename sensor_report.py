@@ -1,8 +1,14 @@
 from cloudbus import cbDevice
+from battery import fleet_battery_life
+from sketches import BucketSketches
 import matplotlib.pyplot as plt
-from datetime import datetime, timedelta
+import matplotlib.dates as mdates
+import numpy as np
+from datetime import datetime, timedelta, timezone
+import hashlib
 import os
 from matplotlib.backends.backend_pdf import PdfPages
+from multiprocessing.pool import ThreadPool
 
 """
 This script will generate a PDF report based on provided device ID values.
@@ -18,6 +24,11 @@ title, Desired SubTitle
 
 The pdf report generated in placed in a subfolder called pdf.  The filename is
 sensor_report.pdf
+
+Fleet-wide percentile bands for the COHORT_ATTRS are drawn behind each device's
+plot. They are built from mergeable per-hour sketches and saved next to the
+report as cohort_<attribute>.json so that a rerun soon after for the same
+devices can reuse them.
 """
 
 
@@ -88,6 +99,183 @@ def create_table_page(pdf, col1, col2, col3, col4, decoration):
     plt.close()
 
 
+class DevicePage:
+    """Reusable figure for the per-device pages
+
+    The figure, axes, labels and date formatting are built once. Each call to
+    render only swaps in the new line data, annotation and title before the
+    page is saved, so the cost per device is drawing rather than building
+    artists, and memory stays flat however many pages are generated.
+
+    Args:
+        attr_list: attributes to plot, one axes each
+        window:    (start, end) naive local datetimes shown on pages where the
+            device has no data at all
+    """
+
+    def __init__(self, attr_list, window):
+        create_fig()
+        self.window = window
+        self.fig = plt.gcf()
+        self.title = self.fig.suptitle('')
+        self.attr_list = attr_list
+        self.axes = []
+        self.lines = []
+        for i, attr in enumerate(attr_list):
+            if i == 0:
+                ax = plt.subplot(len(attr_list), 1, i+1)
+                ax.xaxis_date()
+                locator = mdates.AutoDateLocator()
+                ax.xaxis.set_major_locator(locator)
+                ax.xaxis.set_major_formatter(mdates.AutoDateFormatter(locator))
+            else:
+                ax = plt.subplot(len(attr_list), 1, i+1, sharex=self.axes[0])
+            line, = ax.plot([], [], "-", alpha=0.5)
+            ax.set(ylabel=attr)
+            self.axes.append(ax)
+            self.lines.append(line)
+        self.axes[-1].set(xlabel='Date')
+
+        self.annotation = None
+        if 'battery_remaining' in attr_list:
+            ax = self.axes[attr_list.index('battery_remaining')]
+            self.annotation = ax.annotate('', (0, 0))
+
+        self.fig.autofmt_xdate()     # cleans up the x-axis tick marks
+        # keep the rotation on tick labels that get created for later pages
+        self.axes[-1].tick_params(axis='x', labelrotation=30)
+
+    def render(self, pdf, title, data):
+        """Draw one device page and append it to pdf
+
+        Args:
+            pdf:   the PdfPages to save the page to
+            title: page title
+            data:  dictionary of attribute name to (xlist, y) tuples
+        """
+        self.title.set_text(title)
+        xmin = None
+        xmax = None
+        for attr, ax, line in zip(self.attr_list, self.axes, self.lines):
+            xlist, y = data[attr]
+            line.set_data(xlist, y)
+            if len(xlist) > 0:
+                xmin = xlist[0] if xmin is None else min(xmin, xlist[0])
+                xmax = xlist[-1] if xmax is None else max(xmax, xlist[-1])
+                ax.set_autoscaley_on(True)
+                ax.relim()
+                ax.autoscale_view(scalex=False)
+            else:
+                # auto=True keeps y autoscaling on for the next device's page
+                ax.set_ylim(0, 1, auto=True)
+
+            if attr == 'battery_remaining':
+                # call out the actual battery remaining value, skipping any
+                # readings at the end that couldn't be decoded
+                good = np.flatnonzero(~np.ma.getmaskarray(y))
+                visible = len(good) > 0
+                self.annotation.set_visible(visible)
+                if visible:
+                    last = good[-1]
+                    self.annotation.set_text(y[last])
+                    xy = (mdates.date2num(xlist[last]), y[last])
+                    self.annotation.xy = xy
+                    self.annotation.set_position(xy)
+
+        if xmin is None:
+            # don't leave the previous device's dates on an empty page
+            xmin, xmax = self.window
+        elif xmin == xmax:
+            xmin -= timedelta(hours=1)
+            xmax += timedelta(hours=1)
+        self.axes[0].set_xlim(xmin, xmax)
+
+        pdf.savefig(self.fig)  # This generates pdf page and appends it to the file
+
+    def set_band(self, attr, times, bands):
+        """Draw a fleet percentile band behind an attribute's plot
+
+        The band is the same for every device so it is only drawn once.
+
+        Args:
+            attr:  attribute name
+            times: bucket start times
+            bands: 2D array of low, median and high values per bucket
+        """
+        if attr not in self.attr_list or len(times) == 0:
+            return
+        ax = self.axes[self.attr_list.index(attr)]
+        times = times.astype('datetime64[ms]').astype(datetime)
+        ax.fill_between(times, bands[:, 0], bands[:, -1], color='0.85',
+                        linewidth=0, zorder=0)
+        ax.plot(times, bands[:, len(bands[0]) // 2], '--', color='0.6',
+                linewidth=0.8, zorder=1)
+
+    def close(self):
+        plt.close(self.fig)
+
+
+def fleet_key(agents):
+    """Identifies the set of devices in a report, for checking saved bands"""
+    guids = sorted(device[0] for device in agents if device[0] != 'title')
+    return hashlib.sha1(','.join(guids).encode('utf-8')).hexdigest()
+
+
+def load_cohort(attr, tstart, tend, fleet):
+    """Load saved cohort sketches for attr
+
+    Returns:
+        The saved BucketSketches if they were built for the same devices and
+        about the same time window, otherwise None.
+    """
+    path = os.path.join(pdf_folder, 'cohort_%s.json' % attr)
+    if not os.path.exists(path):
+        return None
+    cohort, meta = BucketSketches.load(path)
+    if meta.get('fleet') != fleet:
+        return None
+    saved_start = datetime.strptime(meta['tstart'], COHORT_TIME_FORMAT)
+    saved_end = datetime.strptime(meta['tend'], COHORT_TIME_FORMAT)
+    if (abs(saved_end - tend) < COHORT_MAX_AGE and
+            abs(saved_start - tstart) < COHORT_MAX_AGE):
+        return cohort
+    return None
+
+
+def save_cohort(cohort, attr, tstart, tend, fleet):
+    path = os.path.join(pdf_folder, 'cohort_%s.json' % attr)
+    cohort.save(path, fleet=fleet,
+                tstart=tstart.strftime(COHORT_TIME_FORMAT),
+                tend=tend.strftime(COHORT_TIME_FORMAT))
+
+
+def sketch_devices(agents, tstart, tend, cohorts):
+    """Sketch every device's data into the cohort bands
+
+    Each worker thread fetches one device's cohort attributes and sketches
+    them. Only the per-device sketches come back to be merged into cohorts, so
+    the fleet's data is never held in memory at once.
+    """
+    def sketch(guid):
+        myDevice = cbDevice(guid)
+        sketches = {}
+        for attr in cohorts:
+            t, y = myDevice.getData(attr, tstart, tend, decode=True)
+            sketches[attr] = BucketSketches()
+            sketches[attr].update(t, y)
+        return sketches
+
+    guids = [device[0] for device in agents if device[0] != 'title']
+    pool = ThreadPool(FETCH_WORKERS)
+    try:
+        for sketches in pool.imap_unordered(sketch, guids):
+            for attr, device_sketches in sketches.items():
+                cohorts[attr].merge(device_sketches)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def load_agents():
     agents = []
     with open('sensor_report.txt', 'r') as fin:
@@ -102,6 +290,18 @@ sensor_agents = load_agents()
 tend = datetime.utcnow()
 tstart = tend - timedelta(days=7)
 
+# fleet percentile bands drawn behind each device's plot
+COHORT_ATTRS = ['temperature', 'rssi']
+COHORT_QUANTILES = (0.05, 0.5, 0.95)
+# saved bands are reused when their time window is within this of the report's
+COHORT_MAX_AGE = timedelta(hours=1)
+COHORT_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+# number of devices whose data is fetched at the same time
+FETCH_WORKERS = 8
+# how far back to look for a battery's last full charge. This must cover the
+# longest expected battery life or long lasting batteries get no estimate.
+BATTERY_LOOKBACK = timedelta(days=5 * 365)
+
 # Create the pdf file
 pdf_folder = r'pdf'
 output_pdf_file = os.path.join(pdf_folder, 'sensor_report.pdf')
@@ -111,54 +311,73 @@ pp = PdfPages(output_pdf_file)
 create_title_page(pp, 'Sensor Report',subtitle=(datetime.isoformat(datetime.now())))
 
 # Generate the details for each device
+attr_list = ['temperature', 'humidity', 'rssi', 'battery_remaining']
+# the report window is in UTC but the pages are plotted in local time
+report_window = tuple(
+    t.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+    for t in (tstart, tend))
+device_page = DevicePage(attr_list, report_window)
+
+# bands saved by an earlier run are reused, the rest are sketched from the
+# fleet's data before any page is drawn
+fleet = fleet_key(sensor_agents)
+cohorts = {}
+build = {}
+for attr in COHORT_ATTRS:
+    cohorts[attr] = load_cohort(attr, tstart, tend, fleet)
+    if cohorts[attr] is None:
+        cohorts[attr] = build[attr] = BucketSketches()
+
+if build:
+    sketch_devices(sensor_agents, tstart, tend, build)
+
+for attr in COHORT_ATTRS:
+    if attr in build:
+        save_cohort(cohorts[attr], attr, tstart, tend, fleet)
+    band_t, bands = cohorts[attr].bands(COHORT_QUANTILES)
+    device_page.set_band(attr, band_t, bands)
+
 for device in sensor_agents:
     if device[0] == 'title':
         create_title_page(pp, device[1])
         continue
 
-    print device
+    print(device)
 
+    # fetched a device at a time so only one page's data is held
     myDevice = cbDevice(device[0])
-
-    attr_list = ['temperature', 'humidity', 'rssi', 'battery_remaining']
-
-    create_fig()
-    fig = plt.gcf()
-    fig.suptitle("%s - %s" % (device[3], device[2]))
-
-    ax = []
-    i = 0
+    data = {}
     for attr in attr_list:
-        if len(ax) == 0:
-            ax.append(plt.subplot(len(attr_list), 1, i+1))
-        else:
-            ax.append(plt.subplot(len(attr_list), 1, i+1, sharex=ax[0]))
-        xlist, ylist = myDevice.getData(attr, tstart, tend)
-        y = [float(y) for y in ylist]
-        ax[i].plot(xlist, y, "-", alpha=0.5)
-        ax[i].set(ylabel=attr)
-        if i+1 == len(attr_list):
-            ax[i].set(xlabel='Date')
-        if attr == 'battery_remaining':
-            if len(y) > 0:
-                # call out the actual battery remaining value
-                plt.annotate(y[-1], (xlist[-1], y[-1]))
-        i += 1
-
-    fig.autofmt_xdate()     # cleans up the x-axis tick marks
+        data[attr] = myDevice.getData(attr, tstart, tend, decode=True)
 
-    pp.savefig(plt.gcf())  # This generates pdf page and appends it to the file
+    device_page.render(pp, "%s - %s" % (device[3], device[2]), data)
 
-    plt.close()  # Close the plot - pyplot doesn't like having lots open
+device_page.close()
 
 # Generate Battery Summary
-print "Running Battery Summary..."
+print("Running Battery Summary...")
 create_title_page(pp, 'Battery Summary')
 col1 = []
 col2 = []
 col3 = []
 col4 = []
 alert = []
+battery_series = []
+for device in sensor_agents:
+    if device[0] == 'title':
+        continue
+
+    myDevice = cbDevice(device[0])
+    # only download as far back as the last full charge, not the whole history
+    battery_series.append(
+        myDevice.scanBackward('battery_remaining', lambda v: v > 0.999,
+                              lookback=BATTERY_LOOKBACK))
+
+# fit the current discharge cycle of every device at once
+battery = fleet_battery_life(battery_series)
+days_per_month = 365.0 / 12.0
+
+i = 0
 for device in sensor_agents:
     if device[0] == 'title':
         col1.append('')
@@ -173,33 +392,36 @@ for device in sensor_agents:
         alert.append('bold')
         continue
 
-    myDevice = cbDevice(device[0])
-    xlist, ylist = myDevice.getData('battery_remaining')
-    y = [float(y) for y in ylist]
-    try:
-        last_full_i = next(i for i in reversed(range(len(y))) if y[i] > 0.999)
-        last_full = xlist[last_full_i]
-        last_full_str = last_full.strftime("%Y/%m/%d")
-        current = y[-1]
-
-        if current < 0.98:
-            est_life = ((xlist[-1] - last_full).total_seconds()) / (1.0 - y[-1]) / (60.0*60.0*24.0*365.0/12.0)
-            est_life_str = "%.2f months" % est_life
-        else:
-            est_life_str = 'Need more data'
-    except:
+    cycle_start = battery['cycle_start'][i]
+    start_level = battery['start_level'][i]
+    current = battery['current'][i]
+    life = battery['life'][i] / days_per_month
+    life_low = battery['life_low'][i] / days_per_month
+    life_high = battery['life_high'][i] / days_per_month
+    i += 1
+
+    # the fitted cycle may start at the oldest point fetched rather than at
+    # a full charge, in which case the last full date isn't known
+    if np.isnat(cycle_start) or not start_level > 0.999:
         last_full_str = 'Unknown'
-        est_life_str = 'Unknown'
+    else:
+        last_full_str = str(cycle_start.astype('datetime64[D]')).replace('-', '/')
 
-    try:
-        current = y[-1]
+    if np.isnan(current):
+        current = 'Unknown'
+        est_life_str = 'Unknown'
+        alert.append(None)
+    else:
+        if current >= 0.98 or np.isnan(life):
+            est_life_str = 'Need more data'
+        elif np.isinf(life_high):
+            est_life_str = "%.2f months (>%.1f)" % (life, life_low)
+        else:
+            est_life_str = "%.2f months (%.1f-%.1f)" % (life, life_low, life_high)
         if current < 0.05:
             alert.append('red')
         else:
             alert.append(None)
-    except:
-        current = 'Unknown'
-        alert.append(None)
 
     col1.append(device[2])
     col2.append("%s" % (last_full_str,))
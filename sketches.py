@@ -0,0 +1,213 @@
+################################################################################
+# Copyright (c) 2017-2022                                                      #
+# Intwine Connect, LLC.                                                        #
+################################################################################
+
+"""Mergeable quantile sketches for fleet-wide percentile bands
+
+Working out, say, the 5th, 50th and 95th percentile of temperature for every
+hour across a whole fleet exactly would mean holding every device's data at
+once. A KLL sketch (Karnin, Lang and Liberty, 2016) instead keeps a small,
+fixed number of samples per value range and answers quantile queries with a
+bounded rank error. Two sketches can be merged into one that describes both
+inputs, so each device (or worker thread or process) can build its own and
+the results are combined afterwards.
+
+BucketSketches keeps one KLLSketch per time bucket. The memory it needs grows
+with the number of buckets, not the number of points, and it can be saved to
+and loaded from a JSON file so the bands can be reused.
+"""
+
+import json
+
+import numpy as np
+
+from counters import _as_values, to_datetime64
+
+# KLL accuracy parameter. The rank error is roughly 1.7 / K.
+K = 200
+# bucket size used by BucketSketches, a numpy datetime unit
+BUCKET = 'h'
+
+_rng = np.random.default_rng()
+
+
+class KLLSketch:
+    """Streaming, mergeable quantile sketch
+
+    Args:
+        k: accuracy parameter, the capacity of the largest compactor
+    """
+
+    def __init__(self, k=K):
+        self.k = k
+        self.n = 0
+        self.levels = [np.empty(0, dtype=np.float64)]
+
+    def __len__(self):
+        return self.n
+
+    def _capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(2, int(np.ceil(self.k * (2.0 / 3.0) ** depth)))
+
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            if len(self.levels[h]) > self._capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0, dtype=np.float64))
+                items = np.sort(self.levels[h])
+                # an odd item out stays behind at this level
+                odd = len(items) % 2
+                promoted = items[odd:][_rng.integers(2)::2]
+                self.levels[h] = items[:odd]
+                self.levels[h + 1] = np.concatenate((self.levels[h + 1],
+                                                     promoted))
+            h += 1
+
+    def update(self, values):
+        """Add values to the sketch. NaN and masked values are ignored."""
+        y = np.ravel(_as_values(values))
+        y = y[~np.isnan(y)]
+        if len(y) == 0:
+            return
+        self.levels[0] = np.concatenate((self.levels[0], y))
+        self.n += len(y)
+        self._compress()
+
+    def merge(self, other):
+        """Fold another sketch into this one"""
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0, dtype=np.float64))
+        for h, items in enumerate(other.levels):
+            self.levels[h] = np.concatenate((self.levels[h], items))
+        self.n += other.n
+        self._compress()
+
+    def quantiles(self, qs):
+        """Estimate quantiles of everything added so far
+
+        Args:
+            qs: sequence of quantiles between 0 and 1
+
+        Returns:
+            A numpy array of estimates, NaN if the sketch is empty.
+        """
+        qs = np.asarray(qs, dtype=np.float64)
+        if self.n == 0:
+            return np.full(qs.shape, np.nan)
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items_h), 2.0 ** h)
+                                  for h, items_h in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        items = items[order]
+        cum = np.cumsum(weights[order])
+        idx = np.searchsorted(cum, qs * cum[-1], side='left')
+        return items[np.minimum(idx, len(items) - 1)]
+
+    def quantile(self, q):
+        return float(self.quantiles([q])[0])
+
+    def to_dict(self):
+        return {'k': self.k, 'n': self.n,
+                'levels': [items.tolist() for items in self.levels]}
+
+    @classmethod
+    def from_dict(cls, d):
+        sketch = cls(d['k'])
+        sketch.n = d['n']
+        sketch.levels = [np.asarray(items, dtype=np.float64)
+                         for items in d['levels']]
+        return sketch
+
+
+class BucketSketches:
+    """One KLLSketch per time bucket
+
+    Args:
+        bucket: numpy datetime unit of the buckets, e.g. 'h' for hourly
+        k:      accuracy parameter of each KLLSketch
+    """
+
+    def __init__(self, bucket=BUCKET, k=K):
+        self.bucket = bucket
+        self.k = k
+        self.sketches = {}
+
+    def __len__(self):
+        return len(self.sketches)
+
+    def update(self, t, y):
+        """Add one device's points to the sketch of the bucket they fall in
+
+        Args:
+            t: point times, anything counters.to_datetime64( ) accepts
+            y: values, the same length as t. NaN and masked values are ignored.
+        """
+        if len(t) == 0:
+            return
+        b = to_datetime64(t).astype('datetime64[%s]' % self.bucket)
+        b = b.astype(np.int64)
+        y = _as_values(y)
+        order = np.argsort(b, kind='stable')
+        keys, first = np.unique(b[order], return_index=True)
+        for key, part in zip(keys.tolist(), np.split(y[order], first[1:])):
+            sketch = self.sketches.get(key)
+            if sketch is None:
+                sketch = self.sketches[key] = KLLSketch(self.k)
+            sketch.update(part)
+
+    def merge(self, other):
+        """Fold another BucketSketches with the same bucket size into this one"""
+        if other.bucket != self.bucket:
+            raise ValueError("Can't merge '%s' buckets into '%s' buckets" %
+                             (other.bucket, self.bucket))
+        for key, sketch in other.sketches.items():
+            if key in self.sketches:
+                self.sketches[key].merge(sketch)
+            else:
+                self.sketches[key] = KLLSketch.from_dict(sketch.to_dict())
+
+    def bands(self, qs=(0.05, 0.5, 0.95)):
+        """Quantiles of every bucket
+
+        Returns:
+            A tuple of the bucket start times as numpy datetime64 and a 2D array
+            with one row per bucket and one column per quantile.
+        """
+        keys = sorted(self.sketches)
+        starts = np.array(keys, dtype=np.int64).astype(
+            'datetime64[%s]' % self.bucket)
+        values = np.array([self.sketches[key].quantiles(qs) for key in keys])
+        return starts, values.reshape(len(keys), len(qs))
+
+    def to_dict(self):
+        return {'bucket': self.bucket, 'k': self.k,
+                'sketches': dict((str(key), sketch.to_dict())
+                                 for key, sketch in self.sketches.items())}
+
+    @classmethod
+    def from_dict(cls, d):
+        buckets = cls(d['bucket'], d['k'])
+        for key, sketch in d['sketches'].items():
+            buckets.sketches[int(key)] = KLLSketch.from_dict(sketch)
+        return buckets
+
+    def save(self, path, **meta):
+        """Write the sketches, and any extra keyword values, to a JSON file"""
+        d = self.to_dict()
+        d['meta'] = meta
+        with open(path, 'w') as fout:
+            json.dump(d, fout)
+
+    @classmethod
+    def load(cls, path):
+        """Read sketches written by save( )
+
+        Returns:
+            A tuple of the BucketSketches and the dictionary of extra values.
+        """
+        with open(path, 'r') as fin:
+            d = json.load(fin)
+        return cls.from_dict(d), d.get('meta', {})
@@ -0,0 +1,376 @@
+################################################################################
+# Copyright (c) 2017-2022                                                      #
+# Intwine Connect, LLC.                                                        #
+################################################################################
+
+"""Compressed in-memory time-series container
+
+Holding weeks of history for thousands of devices as lists of datetimes and
+values costs close to 100 bytes per point. TimeSeries keeps the same data in
+fixed size blocks compressed the way Facebook's Gorilla TSDB does it:
+
+* timestamps are stored as the delta of the delta between samples, which is
+  zero (one bit) for devices that report on a steady interval.
+* values are stored as the XOR of each float with the one before it, keeping
+  only the bits that changed. Slowly moving sensor data takes a handful of bits
+  per point and a repeated value takes one.
+
+Blocks are only decompressed when they are read, and a few recently used
+blocks are kept decompressed so that repeated range reads are cheap. The block
+index holds the first and last timestamp of each block so a range read only
+touches the blocks it overlaps.
+
+Timestamps are integer milliseconds since the Unix epoch, as reported by
+CloudBUS. Use local_datetimes( ) to get the naive local datetimes that
+cbDevice.getData( ) returns.
+"""
+
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+import datetime as dt
+import time
+
+import numpy as np
+
+from counters import _as_values
+
+# points per compressed block
+BLOCK_SIZE = 1024
+# number of decompressed blocks kept by each TimeSeries
+CACHE_BLOCKS = 8
+
+_U64 = np.uint64
+_BIT_INDEX = np.arange(64)
+
+
+def to_millis(t):
+    """Convert a naive local datetime (or epoch milliseconds) to epoch ms"""
+    if isinstance(t, dt.datetime):
+        return int(time.mktime(t.timetuple())) * 1000 + t.microsecond // 1000
+    return int(t)
+
+
+def local_datetimes(t):
+    """Convert epoch milliseconds to a list of naive local datetimes"""
+    return [dt.datetime.fromtimestamp(ms / 1000.0) for ms in np.asarray(t).tolist()]
+
+
+def _pack(codes, lengths):
+    """Pack each code into the given number of bits, most significant first
+
+    Returns:
+        The packed bytes, zero padded to a whole number of bytes.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    shifts = lengths[:, None] - 1 - _BIT_INDEX[None, :]
+    valid = shifts >= 0
+    shifts = np.where(valid, shifts, 0).astype(_U64)
+    bits = (np.asarray(codes, dtype=_U64)[:, None] >> shifts) & _U64(1)
+    return np.packbits(bits[valid].astype(np.uint8)).tobytes()
+
+
+def _interleave(a, b):
+    out = np.empty(2 * len(a), dtype=np.result_type(a, b))
+    out[0::2] = a
+    out[1::2] = b
+    return out
+
+
+def _leading_zeros(x):
+    n = np.zeros(len(x), dtype=np.int64)
+    x = x.copy()
+    for s in (32, 16, 8, 4, 2, 1):
+        m = (x >> _U64(64 - s)) == 0
+        n += m * s
+        x = np.where(m, x << _U64(s), x)
+    return n
+
+
+def _trailing_zeros(x):
+    n = np.zeros(len(x), dtype=np.int64)
+    x = x.copy()
+    for s in (32, 16, 8, 4, 2, 1):
+        m = (x & _U64((1 << s) - 1)) == 0
+        n += m * s
+        x = np.where(m, x >> _U64(s), x)
+    return n
+
+
+def _encode_times(t):
+    """Delta-of-delta encode int64 millisecond timestamps (first one excluded)"""
+    delta = np.diff(t)
+    dod = np.diff(delta, prepend=0)
+    zz = ((dod << 1) ^ (dod >> 63)).view(_U64)  # zigzag so small is short
+
+    prefix = np.full(len(zz), 0b1111, dtype=_U64)
+    prefix_len = np.full(len(zz), 4)
+    payload_len = np.full(len(zz), 64)
+    for limit, code, code_len, bits in ((1 << 12, 0b1110, 4, 12),
+                                        (1 << 9, 0b110, 3, 9),
+                                        (1 << 7, 0b10, 2, 7),
+                                        (1, 0b0, 1, 0)):
+        m = zz < _U64(limit)
+        prefix[m] = code
+        prefix_len[m] = code_len
+        payload_len[m] = bits
+    return _pack(_interleave(prefix, zz), _interleave(prefix_len, payload_len))
+
+
+def _encode_values(y):
+    """Gorilla XOR encode float64 values"""
+    bits = np.ascontiguousarray(y, dtype=np.float64).view(_U64)
+    xor = bits ^ np.concatenate(([_U64(0)], bits[:-1]))
+    lead = np.minimum(_leading_zeros(xor), 31).tolist()
+    trail = _trailing_zeros(xor).tolist()
+
+    n = len(xor)
+    head = np.zeros(n, dtype=_U64)
+    head_len = np.ones(n, dtype=np.int64)
+    shift = np.zeros(n, dtype=np.int64)
+    payload_len = np.zeros(n, dtype=np.int64)
+
+    # the control bits depend on the previously emitted window, so they are
+    # chosen in a plain loop; the bit twiddling itself stays vectorized
+    win_lead, win_trail = 64, 64
+    nonzero = (xor != 0).tolist()
+    for i in range(n):
+        if not nonzero[i]:
+            continue
+        if lead[i] >= win_lead and trail[i] >= win_trail:
+            head[i] = 0b10
+            head_len[i] = 2
+        else:
+            win_lead, win_trail = lead[i], trail[i]
+            head[i] = (0b11 << 11) | (win_lead << 6) | (63 - win_lead - win_trail)
+            head_len[i] = 13
+        shift[i] = win_trail
+        payload_len[i] = 64 - win_lead - win_trail
+
+    payload = xor >> shift.astype(_U64)
+    return _pack(_interleave(head, payload), _interleave(head_len, payload_len))
+
+
+class _BitReader:
+    def __init__(self, data):
+        self.bits = bin(int.from_bytes(data, 'big') | (1 << (8 * len(data))))[3:]
+        self.pos = 0
+
+    def read(self, n):
+        if n == 0:
+            return 0
+        v = int(self.bits[self.pos:self.pos + n], 2)
+        self.pos += n
+        return v
+
+    def bit(self):
+        b = self.bits[self.pos] == '1'
+        self.pos += 1
+        return b
+
+
+def _decode_times(t0, data, n):
+    r = _BitReader(data)
+    t = np.empty(n, dtype=np.int64)
+    t[0] = t0
+    delta = 0
+    for i in range(1, n):
+        if not r.bit():
+            z = 0
+        elif not r.bit():
+            z = r.read(7)
+        elif not r.bit():
+            z = r.read(9)
+        elif not r.bit():
+            z = r.read(12)
+        else:
+            z = r.read(64)
+        delta += (z >> 1) ^ -(z & 1)
+        t[i] = t[i - 1] + delta
+    return t
+
+
+def _decode_values(data, n):
+    r = _BitReader(data)
+    out = np.empty(n, dtype=_U64)
+    prev = 0
+    lead = trail = 0
+    for i in range(n):
+        if r.bit():
+            if r.bit():
+                lead = r.read(5)
+                trail = 63 - lead - r.read(6)
+            prev ^= r.read(64 - lead - trail) << trail
+        out[i] = prev
+    return out.view(np.float64)
+
+
+class _Block:
+    """One compressed run of points"""
+
+    __slots__ = ('tmin', 'tmax', 'n', 't_bytes', 'y_bytes')
+
+    def __init__(self, t, y):
+        self.tmin = int(t[0])
+        self.tmax = int(t[-1])
+        self.n = len(t)
+        self.t_bytes = _encode_times(t)
+        self.y_bytes = _encode_values(y)
+
+    @property
+    def nbytes(self):
+        return len(self.t_bytes) + len(self.y_bytes) + 40
+
+    def decode(self):
+        t = _decode_times(self.tmin, self.t_bytes, self.n)
+        y = _decode_values(self.y_bytes, self.n)
+        t.flags.writeable = False
+        y.flags.writeable = False
+        return t, y
+
+
+class TimeSeries:
+    """Compressed time-series of float values
+
+    Points are appended in time order. Every block_size points are sealed into
+    a compressed block; the remainder is kept uncompressed until it fills up.
+
+    Args:
+        block_size:   number of points per compressed block
+        cache_blocks: number of decompressed blocks to keep around
+    """
+
+    def __init__(self, block_size=BLOCK_SIZE, cache_blocks=CACHE_BLOCKS):
+        self.block_size = block_size
+        self.cache_blocks = cache_blocks
+        self._blocks = []
+        self._tmin = []   # block index, first timestamp of each block
+        self._tmax = []   # block index, last timestamp of each block
+        self._tail_t = np.empty(0, dtype=np.int64)
+        self._tail_y = np.empty(0, dtype=np.float64)
+        self._cache = OrderedDict()
+
+    @classmethod
+    def from_arrays(cls, t, y, **kwargs):
+        """Build a TimeSeries from epoch ms timestamps and values"""
+        ts = cls(**kwargs)
+        ts.append(t, y)
+        return ts
+
+    def __len__(self):
+        return sum(b.n for b in self._blocks) + len(self._tail_t)
+
+    def __repr__(self):
+        return "TimeSeries(%d points, %d blocks, %d bytes)" % (
+            len(self), len(self._blocks), self.nbytes)
+
+    @property
+    def nbytes(self):
+        """Approximate memory used by the compressed data"""
+        return (sum(b.nbytes for b in self._blocks) +
+                self._tail_t.nbytes + self._tail_y.nbytes)
+
+    @property
+    def block_count(self):
+        return len(self._blocks)
+
+    def append(self, t, y):
+        """Append points to the end of the series
+
+        Args:
+            t: epoch ms timestamps, sorted and not earlier than the last point
+            y: float values, the same length as t
+        """
+        t = np.asarray(t, dtype=np.int64)
+        y = _as_values(y)
+        if len(t) != len(y):
+            raise ValueError("t and y must be the same length")
+        if len(t) == 0:
+            return
+        last = self._last_time()
+        if np.any(np.diff(t) < 0) or (last is not None and t[0] < last):
+            raise ValueError("TimeSeries points must be appended in time order")
+
+        t = np.concatenate((self._tail_t, t))
+        y = np.concatenate((self._tail_y, y))
+        full = len(t) - len(t) % self.block_size
+        for i in range(0, full, self.block_size):
+            block = _Block(t[i:i + self.block_size], y[i:i + self.block_size])
+            self._blocks.append(block)
+            self._tmin.append(block.tmin)
+            self._tmax.append(block.tmax)
+        self._tail_t = t[full:].copy()
+        self._tail_y = y[full:].copy()
+
+    def _last_time(self):
+        if len(self._tail_t):
+            return int(self._tail_t[-1])
+        if self._blocks:
+            return self._tmax[-1]
+        return None
+
+    def block(self, i):
+        """Returns the decompressed (t, y) arrays of block i
+
+        The arrays are read-only and shared with the cache, so no copy is made.
+        """
+        if i in self._cache:
+            self._cache.move_to_end(i)
+            return self._cache[i]
+        arrays = self._blocks[i].decode()
+        self._cache[i] = arrays
+        while len(self._cache) > self.cache_blocks:
+            self._cache.popitem(last=False)
+        return arrays
+
+    def slice(self, tstart=None, tend=None):
+        """Returns the points with tstart <= t <= tend
+
+        Args:
+            tstart: optional naive local datetime or epoch ms. Defaults to the
+                start of the series.
+            tend:   optional naive local datetime or epoch ms. Defaults to the
+                end of the series.
+
+        Returns:
+            A tuple of read-only numpy arrays, epoch ms timestamps and float
+            values. When the range falls inside a single block, or inside the
+            points not yet sealed into a block, these are views and no data is
+            copied.
+        """
+        lo = -np.inf if tstart is None else to_millis(tstart)
+        hi = np.inf if tend is None else to_millis(tend)
+
+        parts_t = []
+        parts_y = []
+        first = bisect_left(self._tmax, lo)
+        last = bisect_right(self._tmin, hi)
+        for i in range(first, last):
+            t, y = self.block(i)
+            a = np.searchsorted(t, lo, side='left')
+            b = np.searchsorted(t, hi, side='right')
+            parts_t.append(t[a:b])
+            parts_y.append(y[a:b])
+        if len(self._tail_t):
+            a = np.searchsorted(self._tail_t, lo, side='left')
+            b = np.searchsorted(self._tail_t, hi, side='right')
+            if b > a:
+                # read-only like the cached blocks, so callers can't change
+                # points that will be encoded by the next append
+                t = self._tail_t[a:b]
+                y = self._tail_y[a:b]
+                t.flags.writeable = False
+                y.flags.writeable = False
+                parts_t.append(t)
+                parts_y.append(y)
+
+        parts = [(t, y) for t, y in zip(parts_t, parts_y) if len(t)]
+        if not parts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        if len(parts) == 1:
+            return parts[0]
+        return (np.concatenate([p[0] for p in parts]),
+                np.concatenate([p[1] for p in parts]))
+
+    def to_numpy(self):
+        """Returns every point as a tuple of (epoch ms, value) numpy arrays"""
+        return self.slice()